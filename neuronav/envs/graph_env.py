@@ -4,7 +4,13 @@ import neuronav.utils as utils
 import enum
 import numpy as np
 from gym import Env, spaces
-from neuronav.envs.graph_structures import GraphStructure, structure_map
+from neuronav.envs.graph_structures import (
+    GraphStructure,
+    get_structure,
+    cumulative_probs,
+    pad_neighbors,
+    to_csr,
+)
 
 
 class GraphObsType(enum.Enum):
@@ -43,7 +49,11 @@ class GraphEnv(Env):
             self.images = utils.cifar10()
 
     def generate_graph(self, structure: GraphStructure):
-        self.struct_objects, self.edges = structure_map[structure]()
+        objects, edges, _ = get_structure(structure)
+        self.neighbors = None
+        # Structures are cached and read-only, so keep mutable copies per env.
+        self.struct_objects = {'rewards': dict(objects['rewards'])}
+        self.edges = [list(edge) for edge in edges]
         self.agent_start_pos = 0
         action_size = 0
         for edge in self.edges:
@@ -66,6 +76,19 @@ class GraphEnv(Env):
         else:
             return None
 
+    def get_neighbors(self, states, rebuild: bool = False):
+        """
+        Returns the neighbors of a batch of states as a (len(states), max_degree)
+        array, padded with -1. Columns are the possible next states rather than
+        action slots, so the outcomes of a stochastic edge each get a column.
+        The table is built from `self.edges` on first use; pass `rebuild=True`
+        after changing `self.edges` to build it again.
+        """
+        if self.neighbors is None or rebuild:
+            indptr, indices, delta, _ = to_csr(self.edges)
+            self.neighbors = pad_neighbors(indices, indptr, delta.max(), -1)
+        return self.neighbors[np.asarray(states)]
+
     def get_free_spot(self):
         return np.random.randint(0, self.state_size)
 
@@ -142,9 +165,13 @@ class GraphEnv(Env):
         else:
             candidate_positions = self.edges[self.agent_pos][action]
             if type(candidate_positions) == tuple:
-                candidate_position = np.random.choice(
-                    candidate_positions[0], p=candidate_positions[1]
-                )
+                targets, probs = candidate_positions
+                cumprobs = cumulative_probs(tuple(probs))
+                # Scaling by the total keeps the index in range despite rounding
+                sample = np.random.random() * cumprobs[-1]
+                candidate_position = targets[
+                    np.searchsorted(cumprobs, sample, side="right")
+                ]
             else:
                 candidate_position = candidate_positions
             self.agent_pos = candidate_position
@@ -1,6 +1,15 @@
 import enum
+from functools import lru_cache
+from types import MappingProxyType
 import numpy as np
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the kernels below run as plain NumPy
+    def njit(func):
+        return func
+
 
 class GraphStructure(enum.Enum):
     two_step = "two_step"
@@ -16,49 +25,113 @@ class GraphStructure(enum.Enum):
     three_arm_bandit = "three_arm_bandit"
 
 
+def _freeze(reward_locs, edges):
+    """
+    Converts a built structure into a read-only form, so that the
+    cached result can be shared safely between environments.
+    """
+    objects = MappingProxyType({'rewards': MappingProxyType(reward_locs)})
+    edges = tuple(tuple(edge) for edge in edges)
+    return objects, edges
+
+
+def to_csr(edges):
+    """
+    Converts a list of edges into a compressed sparse row (CSR) layout.
+    Returns (indptr, indices, delta, probs), where delta is the out-degree
+    of each state. Stochastic edges are expanded into each of their possible
+    targets, with probs holding the transition probability of each entry.
+    """
+    delta = np.zeros(len(edges), dtype=np.int32)
+    indices = []
+    probs = []
+    for idx, edge in enumerate(edges):
+        for target in edge:
+            if type(target) == tuple:
+                indices.extend(target[0])
+                probs.extend(target[1])
+                delta[idx] += len(target[0])
+            else:
+                indices.append(target)
+                probs.append(1.0)
+                delta[idx] += 1
+    indptr = np.zeros(len(edges) + 1, dtype=np.int32)
+    np.cumsum(delta, out=indptr[1:])
+    indices = np.array(indices, dtype=np.int32)
+    probs = np.array(probs, dtype=np.float32)
+    return indptr, indices, delta, probs
+
+
+@njit
+def pad_neighbors(data, indptr, max_indices, fill_value):
+    """
+    Expands the rows of a CSR array into a dense (n, max_indices) array,
+    padding rows with fewer than max_indices entries with fill_value.
+    """
+    num_rows = len(indptr) - 1
+    out = np.empty((num_rows, max_indices), dtype=data.dtype)
+    out[:] = fill_value
+    for i in range(num_rows):
+        start = indptr[i]
+        end = min(indptr[i + 1], start + max_indices)
+        out[i, : end - start] = data[start:end]
+    return out
+
+
+@lru_cache(maxsize=64)
+def cumulative_probs(probs: tuple):
+    """
+    Returns the read-only cumulative distribution of the transition
+    probabilities of a stochastic edge, for sampling with np.searchsorted.
+    """
+    cumprobs = np.cumsum(probs)
+    cumprobs.setflags(write=False)
+    return cumprobs
+
+
+@lru_cache(maxsize=None)
 def two_step():
     reward_locs = {3: 1, 4: -1, 5: 0.5, 6: 0.5}
     edges = [[1, 2], [3, 4], [5, 6], [], [], [], []]
-    objects = {'rewards': reward_locs}
-    return objects, edges
+    return _freeze(reward_locs, edges)
 
 
+@lru_cache(maxsize=None)
 def three_arm_bandit():
     reward_locs = {1: 1, 2: 0.5, 3: -0.5}
     edges = [[1, 2, 3], [], [], []]
-    objects = {'rewards': reward_locs}
-    return objects, edges
-
+    return _freeze(reward_locs, edges)
 
 
+@lru_cache(maxsize=None)
 def two_way_linear():
     reward_locs = {4: 1}
     edges = [[0, 1], [0, 2], [1, 3], [2, 4], [3, 4]]
-    objects = {'rewards': reward_locs}
-    return objects, edges
+    return _freeze(reward_locs, edges)
 
 
+@lru_cache(maxsize=None)
 def ring():
     reward_locs = {4: 1}
     edges = [[1, 5], [0, 2], [1, 3], [2, 4], [3, 5], [4, 0]]
-    objects = {'rewards': reward_locs}
-    return objects, edges
+    return _freeze(reward_locs, edges)
 
 
+@lru_cache(maxsize=None)
 def linear():
     reward_locs = {5: 1}
     edges = [[1], [2], [3], [4], [5], []]
-    objects = {'rewards': reward_locs}
-    return objects, edges
+    return _freeze(reward_locs, edges)
 
 
+@lru_cache(maxsize=None)
 def t_graph():
     reward_locs = {5: 1}
     edges = [[1, 0], [2, 1], [3, 4], [5, 3], [6, 4], [], []]
-    objects = {'rewards': reward_locs}
-    return objects, edges
+    return _freeze(reward_locs, edges)
 
 
+@lru_cache(maxsize=None)
 def neighborhood():
     reward_locs = {14: 1}
     edges = [
@@ -78,24 +151,24 @@ def neighborhood():
         [11, 10, 12, 14],
         [10, 12, 11, 13],
     ]
-    objects = {'rewards': reward_locs}
-    return objects, edges
+    return _freeze(reward_locs, edges)
 
 
+@lru_cache(maxsize=None)
 def human_a():
     reward_locs = {4: 10, 5: 1}
     edges = [[2], [3], [4], [5], [], []]
-    objects = {'rewards': reward_locs}
-    return objects, edges
+    return _freeze(reward_locs, edges)
 
 
+@lru_cache(maxsize=None)
 def human_b():
     reward_locs = {3: 15, 5: 30}
     edges = [[1, 2], [3, 4], [4, 5], [3, 3], [4, 4], [5, 5]]
-    objects = {'rewards': reward_locs}
-    return objects, edges
+    return _freeze(reward_locs, edges)
 
 
+@lru_cache(maxsize=None)
 def t_loop():
     reward_locs = {12: 1, 11: 1}
     edges = [
@@ -113,38 +186,33 @@ def t_loop():
         [0, 11],
         [0, 12],
     ]
-    objects = {'rewards': reward_locs}
-    return objects, edges
+    return _freeze(reward_locs, edges)
+
 
+# Values taken from original author's code availabe here: https://osf.io/ux5rg/
+_VM_FMAX = 10.0
+_VM_SIGMA = 200.0
+_VM_MAGNITUDES = np.array([0.1, 0.3, 1.2, 2.5, 5, 10, 20], dtype=np.float64)
+_VM_ROOTS = np.sqrt(np.abs(_VM_MAGNITUDES))
+_VM_UTILITIES = (_VM_FMAX * np.sign(_VM_MAGNITUDES) * _VM_ROOTS) / (
+    _VM_ROOTS + np.sqrt(_VM_SIGMA)
+)
+_VM_REWARDS = {idx + 1: float(utility) for idx, utility in enumerate(_VM_UTILITIES)}
+_VM_EDGES = [
+    [((1, 2, 3, 4, 5, 6, 7), (0.067, 0.090, 0.148, 0.154, 0.313, 0.151, 0.077))],
+    [],
+    [],
+    [],
+    [],
+    [],
+    [],
+    [],
+]
 
+
+@lru_cache(maxsize=None)
 def variable_magnitude():
-    # Values taken from original author's code availabe here: https://osf.io/ux5rg/
-    fmax = 10.0
-    sigma = 200
-    utility_func = lambda r: (fmax * np.sign(r) * np.abs(r) ** (0.5)) / (
-        np.abs(r) ** (0.5) + sigma ** (0.5)
-    )
-    reward_locs = {
-        1: utility_func(0.1),
-        2: utility_func(0.3),
-        3: utility_func(1.2),
-        4: utility_func(2.5),
-        5: utility_func(5),
-        6: utility_func(10),
-        7: utility_func(20),
-    }
-    edges = [
-        [((1, 2, 3, 4, 5, 6, 7), (0.067, 0.090, 0.148, 0.154, 0.313, 0.151, 0.077))],
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-        [],
-    ]
-    objects = {'rewards': reward_locs}
-    return objects, edges
+    return _freeze(_VM_REWARDS, _VM_EDGES)
 
 
 structure_map = {
@@ -160,3 +228,34 @@ structure_map = {
     GraphStructure.variable_magnitude: variable_magnitude,
     GraphStructure.three_arm_bandit: three_arm_bandit,
 }
+
+
+def _build_structure(structure: GraphStructure):
+    objects, edges = structure_map[structure]()
+    csr = to_csr(edges)
+    for array in csr:
+        array.setflags(write=False)
+    return objects, edges, csr
+
+
+# Every structure is built once at import time and stored in the order of
+# GraphStructure, so that fetching one is a single tuple index.
+_STRUCTURES = tuple(_build_structure(structure) for structure in GraphStructure)
+_STRUCTURE_INDEX = {structure.name: idx for idx, structure in enumerate(GraphStructure)}
+
+
+def get_structure(structure: GraphStructure):
+    """
+    Returns the prebuilt (objects, edges, csr) of a graph structure,
+    where csr is (indptr, indices, delta, probs).
+    """
+    return _STRUCTURES[_STRUCTURE_INDEX[structure.name]]
+
+
+def structure_csr(structure: GraphStructure):
+    """
+    Returns the objects of a graph structure along with its edges
+    in CSR layout, as (objects, (indptr, indices, delta, probs)).
+    """
+    objects, _, csr = get_structure(structure)
+    return objects, csr
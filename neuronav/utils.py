@@ -1,12 +1,13 @@
 from typing import Dict
+from functools import lru_cache
 import numpy as np
 import tarfile
 import os
-from urllib.request import urlretrieve
+import hashlib
+from urllib.request import urlopen
 from gym import Env
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
-import matplotlib.cm as cm
 
 
 def run_episode(
@@ -19,10 +20,13 @@ def run_episode(
     update_agent: bool = True,
     time_penalty: float = 0.0,
     collect_states: bool = False,
+    collect_transitions: bool = False,
 ):
     """
     Performs a single episode of actions with the policy
     of a given agent in a given environment.
+    If `collect_transitions` is set, the (obs, act, obs_new, reward, done)
+    of every step are also returned as a structured array.
     """
     obs = env.reset(
         agent_pos=start_pos,
@@ -31,67 +35,231 @@ def run_episode(
         time_penalty=time_penalty,
     )
     agent.reset()
+    # Bind the methods called every step once, outside of the loop.
+    sample_action = agent.sample_action
+    env_step = env.step
+    agent_update = agent.update
     steps = 0
     episode_return = 0
     done = False
     if collect_states:
-        states = []
+        states = np.empty((max_steps,) + np.shape(obs), dtype=np.asarray(obs).dtype)
+    if collect_transitions:
+        obs_field = (np.asarray(obs).dtype, np.shape(obs))
+        transition_dtype = np.dtype(
+            [
+                ("obs",) + obs_field,
+                ("act", np.int32),
+                ("obs_new",) + obs_field,
+                ("reward", np.float64),
+                ("done", np.bool_),
+            ]
+        )
+        transitions = np.empty(max_steps, dtype=transition_dtype)
     while not done and steps < max_steps:
-        act = agent.sample_action(obs)
-        obs_new, reward, done, _ = env.step(act)
+        act = sample_action(obs)
+        obs_new, reward, done, _ = env_step(act)
         if update_agent:
-            _ = agent.update([obs, act, obs_new, reward, done])
+            _ = agent_update([obs, act, obs_new, reward, done])
         if collect_states:
-            states.append(obs)
+            states[steps] = obs
+        if collect_transitions:
+            transitions[steps] = (obs, act, obs_new, reward, done)
         obs = obs_new
         steps += 1
         episode_return += reward
+    results = (agent, steps, episode_return)
     if collect_states:
-        return agent, steps, episode_return, states
-    else:
-        return agent, steps, episode_return
+        results += (states[:steps],)
+    if collect_transitions:
+        results += (transitions[:steps],)
+    return results
+
+
+def run_episode_scan(
+    env_step,
+    agent_step,
+    agent_update,
+    max_steps: int,
+    env_state,
+    agent_state,
+    obs,
+    key,
+):
+    """
+    Performs a single episode of actions with `jax.lax.scan`. The environment
+    and agent are given as pure JAX functions:
+        env_step(env_state, action, key) -> (env_state, obs, reward, done)
+        agent_step(agent_state, obs, key) -> action
+        agent_update(agent_state, transition) -> agent_state
+    `agent_update` may be None to leave the agent unchanged. Steps after the
+    episode finishes are masked out rather than skipped, so every episode
+    runs for `max_steps` iterations. Returns the final agent state, the
+    number of steps, the episode return, and the per-step transitions, where
+    `transitions["valid"]` marks the steps which belong to the episode.
+    Requires `jax`, which can be installed with `pip install neuronav[jax]`.
+    """
+    import jax
+    import jax.numpy as jnp
+
+    def select(pred, on_true, on_false):
+        return jax.tree_util.tree_map(
+            lambda a, b: jnp.where(pred, a, b), on_true, on_false
+        )
+
+    def _step_fn(carry, _):
+        key, env_state, agent_state, obs, done = carry
+        key, act_key, env_key = jax.random.split(key, 3)
+        act = agent_step(agent_state, obs, act_key)
+        next_env_state, obs_new, reward, next_done = env_step(env_state, act, env_key)
+        valid = jnp.logical_not(done)
+        if agent_update is not None:
+            next_agent_state = agent_update(
+                agent_state, (obs, act, obs_new, reward, next_done)
+            )
+            agent_state = select(valid, next_agent_state, agent_state)
+        env_state = select(valid, next_env_state, env_state)
+        transition = {
+            "obs": obs,
+            "act": act,
+            "obs_new": obs_new,
+            "reward": reward * valid,
+            "done": next_done,
+            "valid": valid,
+        }
+        obs = select(valid, obs_new, obs)
+        done = jnp.logical_or(done, next_done)
+        return (key, env_state, agent_state, obs, done), transition
+
+    init = (key, env_state, agent_state, obs, jnp.array(False))
+    (_, _, agent_state, _, _), transitions = jax.lax.scan(
+        _step_fn, init, None, length=max_steps
+    )
+    steps = transitions["valid"].sum()
+    episode_return = transitions["reward"].sum()
+    return agent_state, steps, episode_return, transitions
+
+
+# Identity matrices used by `onehot`, keyed by size. Only small sizes are
+# cached, since each matrix grows quadratically with `max_value`.
+_EYE_CACHE = {}
+_EYE_CACHE_MAX = 1024
 
 
 def onehot(value: int, max_value: int):
     """
     Creates a onehot encoding of an integer number.
+    For small sizes the result is copied from a row of a cached identity matrix.
     """
-    vec = np.zeros(max_value, dtype=np.int32)
     value = np.clip(value, 0, max_value - 1)
-    vec[value] = 1
-    return vec
+    if max_value > _EYE_CACHE_MAX:
+        vec = np.zeros(max_value, dtype=np.int32)
+        vec[value] = 1
+        return vec
+    eye = _EYE_CACHE.get(max_value)
+    if eye is None:
+        eye = np.eye(max_value, dtype=np.int32)
+        eye.setflags(write=False)
+        _EYE_CACHE[max_value] = eye
+    return eye[value].copy()
+
+
+def onehot_batch(values: np.ndarray, max_value: int):
+    """
+    Creates a matrix whose rows are onehot encodings of a batch of integers.
+    """
+    values = np.clip(np.asarray(values), 0, max_value - 1)
+    vecs = np.zeros((len(values), max_value), dtype=np.int32)
+    vecs[np.arange(len(values)), values] = 1
+    return vecs
 
 
-def twohot(value, max_value):
+def twohot(value, max_value, out=None):
     """
     Creates a two-hot encoding of a given pair of integers.
+    If provided, `out` is used as the buffer for the result.
+    """
+    if out is None:
+        out = np.zeros(2 * max_value, dtype=np.float32)
+    else:
+        out[:] = 0
+    out[value[0]] = 1
+    out[max_value + value[1]] = 1
+    return out
+
+
+def twohot_batch(values: np.ndarray, max_value: int):
+    """
+    Creates a matrix whose rows are two-hot encodings of a batch of
+    integer pairs, given as an array of shape (batch, 2).
     """
-    vec_1 = np.zeros(max_value, dtype=np.float32)
-    vec_2 = np.zeros(max_value, dtype=np.float32)
-    vec_1[value[0]] = 1
-    vec_2[value[1]] = 1
-    return np.concatenate([vec_1, vec_2])
+    values = np.asarray(values)
+    rows = np.arange(len(values))
+    vecs = np.zeros((len(values), 2 * max_value), dtype=np.float32)
+    vecs[rows, values[:, 0]] = 1
+    vecs[rows, max_value + values[:, 1]] = 1
+    return vecs
 
 
 def create_circular_mask(h, w, center=None, radius=None):
+    """
+    Returns a read-only boolean mask of a circle in an h x w grid.
+    Masks are cached, as the same few are requested repeatedly.
+    """
     if center is None:
         center = [int(w / 2), int(h / 2)]
     if radius is None:
         radius = min(center[0], center[1], w - center[0], h - center[1])
+    return _circular_mask(h, w, tuple(center), radius)
 
-    Y, X = np.ogrid[:h, :w]
-    dist_from_center = np.sqrt((X - center[0]) ** 2 + (Y - center[1]) ** 2)
 
-    mask = dist_from_center <= radius
+@lru_cache(maxsize=64)
+def _circular_mask(h, w, center, radius):
+    Y, X = np.ogrid[:h, :w]
+    dx = X - center[0]
+    dy = Y - center[1]
+    # Compare squared distances, which avoids taking a square root
+    # -- Integral centers use int32 math, others keep their fractional part
+    if float(center[0]).is_integer() and float(center[1]).is_integer():
+        dx = dx.astype(np.int32)
+        dy = dy.astype(np.int32)
+
+    mask = dx * dx + dy * dy <= radius * radius
+    mask.setflags(write=False)
     return mask
 
 
-def softmax(x, axis=-1):
+def softmax(x, axis=-1, out=None):
     """
-    Computes the softmax function on a given vector.
+    Computes the softmax function on a given array along an axis.
+    If provided, `out` is used as the buffer for the result.
     """
-    e_x = np.exp(x - np.max(x))
-    return e_x / np.sum(e_x, axis=axis)
+    if out is None:
+        e_x = np.exp(x - np.max(x, axis=axis, keepdims=True))
+        return e_x / e_x.sum(axis=axis, keepdims=True)
+    np.subtract(x, np.max(x, axis=axis, keepdims=True), out=out)
+    np.exp(out, out=out)
+    out /= out.sum(axis=axis, keepdims=True)
+    return out
+
+
+# Colormaps and reward colors used by `plot_values_and_policy`
+_CMAP_RDBU = plt.get_cmap("RdBu")
+_CMAP_PIYG = plt.get_cmap("PiYG")
+_POS_REWARD_COLOR = _CMAP_RDBU(0.75)
+_NEG_REWARD_COLOR = _CMAP_RDBU(0.25)
+
+# Policy arrows as (x, y, dx, dy) relative to the cell, indexed by action
+_ARROWS = np.array(
+    [
+        [0, 0.5, 0, -0.5],
+        [-0.5, 0, 0.5, 0],
+        [0, -0.5, 0, 0.5],
+        [0.5, 0, -0.5, 0],
+        [0, 0, 0, 0],
+    ],
+    dtype=np.float32,
+)
 
 
 def plot_values_and_policy(
@@ -103,19 +271,14 @@ def plot_values_and_policy(
     objects: dict = None,
     subplot=None,
     plot_sr=None,
+    colorbar=None,
 ):
     """
     Plots the V(s) and argmax policy for a given agent in a given environment.
     Agent must have an `agent.Q` function.
+    An existing `colorbar` can be passed in to be updated instead of creating
+    a new one. The colorbar of a plot is available as `ax.images[-1].colorbar`.
     """
-    arrows = [
-        [0, 0.5, 0, -0.5],
-        [-0.5, 0, 0.5, 0],
-        [0, -0.5, 0, 0.5],
-        [0.5, 0, -0.5, 0],
-        [0, 0, 0, 0],
-    ]
-
     states = []
     if rollout:
         _, _, _, states = run_episode(
@@ -135,85 +298,152 @@ def plot_values_and_policy(
         _, ax = plt.subplots()
     else:
         ax = subplot
-    cmap = cm.get_cmap("RdBu")
-    blue = cmap(1.0)
-    red = cmap(0.0)
 
+    grid_size = env.grid_size
     if agent is not None:
         V = agent.Q.mean(0)
+        policy = agent.Q.argmax(0).reshape(grid_size, grid_size)
     else:
-        V = np.zeros([env.grid_size, env.grid_size])
+        V = np.zeros([grid_size, grid_size])
     if plot_sr is None:
         im = ax.imshow(
-            V.reshape(env.grid_size, env.grid_size), cmap="RdBu", vmin=-1.0, vmax=1.0
+            V.reshape(grid_size, grid_size), cmap=_CMAP_RDBU, vmin=-1.0, vmax=1.0
         )
     else:
-        im = ax.imshow(plot_sr, cmap="PiYG", vmin=-1.0, vmax=1.0)
-    for i in range(env.grid_size):
-        for j in range(env.grid_size):
-            if rollout:
-                if env.get_observation([i, j]) in states:
-                    use_alpha = 1.0
-                else:
-                    use_alpha = 0.25
-            else:
-                use_alpha = 0.5
-            if agent is not None:
-                use_dir = agent.Q.argmax(0).reshape(env.grid_size, env.grid_size)[i, j]
-                use_arrow = arrows[use_dir].copy()
-                use_arrow[0] += j
-                use_arrow[1] += i
-            if [i, j] not in env.blocks:
-                if [i, j] == list(start_pos):
-                    ax.text(
-                        j,
-                        i + 0.25,
-                        "S",
-                        fontdict={"fontsize": 16, "weight": "bold", "ha": "center"},
-                    )
-                elif (i, j) in objects['rewards'].keys():
-                    reward_val = objects['rewards'][(i, j)]
-                    if reward_val > 0:
-                        use_color = cmap(0.75)
-                    else:
-                        use_color = cmap(0.25)
-                    box = patches.Rectangle(
-                        (j - 0.5, i - 0.5), 1.0, 1.0, color=use_color, alpha=0.5
-                    )
-                    ax.add_patch(box)
-                    ax.text(
-                        j,
-                        i + 0.15,
-                        str(reward_val),
-                        fontdict={"fontsize": 11, "ha": "center"},
-                    )
-                else:
-                    if agent is not None and plot_sr is None:
-                        ax.arrow(
-                            use_arrow[0],
-                            use_arrow[1],
-                            use_arrow[2],
-                            use_arrow[3],
-                            head_width=0.33,
-                            head_length=0.33,
-                            fc="k",
-                            ec="k",
-                            alpha=use_alpha,
-                        )
-            else:
-                box = patches.Rectangle(
-                    (j - 0.33, i - 0.33), 0.66, 0.66, color="black", alpha=0.25
-                )
-                ax.add_patch(box)
+        im = ax.imshow(plot_sr, cmap=_CMAP_PIYG, vmin=-1.0, vmax=1.0)
+
+    if rollout:
+        obs_grid = np.array(
+            [
+                [env.get_observation([i, j]) for j in range(grid_size)]
+                for i in range(grid_size)
+            ]
+        )
+        visited = np.zeros(env.state_size, dtype=bool)
+        visited[states] = True
+        alphas = np.where(visited[obs_grid], 1.0, 0.25)
+    else:
+        alphas = np.full([grid_size, grid_size], 0.5)
+
+    # Arrows are drawn on every free cell which is not the start or a reward
+    arrow_mask = np.ones([grid_size, grid_size], dtype=bool)
+    for i, j in env.blocks:
+        if not arrow_mask[i, j]:
+            continue
+        arrow_mask[i, j] = False
+        box = patches.Rectangle(
+            (j - 0.33, i - 0.33), 0.66, 0.66, color="black", alpha=0.25
+        )
+        ax.add_patch(box)
+    start_i, start_j = start_pos
+    if arrow_mask[start_i, start_j]:
+        arrow_mask[start_i, start_j] = False
+        ax.text(
+            start_j,
+            start_i + 0.25,
+            "S",
+            fontdict={"fontsize": 16, "weight": "bold", "ha": "center"},
+        )
+    # Rewards may be keyed by (i, j) coordinates or by flat state index
+    reward_mask = np.zeros([grid_size, grid_size], dtype=bool)
+    reward_vals = np.zeros([grid_size, grid_size])
+    # The original values are kept for labels, so that e.g. 1 is not shown as 1.0
+    reward_labels = {}
+    for loc, reward_val in objects['rewards'].items():
+        if np.isscalar(loc):
+            loc = divmod(int(loc), grid_size)
+        loc = tuple(loc)
+        reward_mask[loc] = True
+        reward_vals[loc] = reward_val
+        reward_labels[loc] = reward_val
+    reward_mask &= arrow_mask
+    arrow_mask &= ~reward_mask
+    for i, j in zip(*np.nonzero(reward_mask)):
+        if reward_vals[i, j] > 0:
+            use_color = _POS_REWARD_COLOR
+        else:
+            use_color = _NEG_REWARD_COLOR
+        box = patches.Rectangle(
+            (j - 0.5, i - 0.5), 1.0, 1.0, color=use_color, alpha=0.5
+        )
+        ax.add_patch(box)
+        ax.text(
+            j,
+            i + 0.15,
+            str(reward_labels[i, j]),
+            fontdict={"fontsize": 11, "ha": "center"},
+        )
+
+    if agent is not None and plot_sr is None:
+        arrows = _ARROWS[policy]
+        arrows[..., 0] += np.arange(grid_size)[None, :]
+        arrows[..., 1] += np.arange(grid_size)[:, None]
+        use_arrows = arrows[arrow_mask]
+        # Arrow heads extend past the end of each arrow, as with `ax.arrow`
+        head_size = 0.33
+        lengths = np.hypot(use_arrows[:, 2], use_arrows[:, 3])
+        scale = np.divide(
+            lengths + head_size, lengths, out=np.zeros_like(lengths), where=lengths > 0
+        )
+        colors = np.zeros([len(use_arrows), 4])
+        colors[:, 3] = alphas[arrow_mask]
+        shaft_width = 0.02
+        ax.quiver(
+            use_arrows[:, 0],
+            use_arrows[:, 1],
+            use_arrows[:, 2] * scale,
+            use_arrows[:, 3] * scale,
+            color=colors,
+            # Outline each arrow in the same color, as `ax.arrow` does with ec="k"
+            edgecolor=colors,
+            linewidth=1.0,
+            angles="xy",
+            scale_units="xy",
+            scale=1,
+            units="xy",
+            width=shaft_width,
+            headwidth=head_size / shaft_width,
+            headlength=head_size / shaft_width,
+            headaxislength=head_size / shaft_width,
+        )
     if agent is not None:
-        cbar = plt.colorbar(im, ax=ax)
-        cbar.set_label("Value Estimates", rotation=270, labelpad=20, fontsize=14)
+        if colorbar is None:
+            cbar = plt.colorbar(im, ax=ax)
+            cbar.set_label("Value Estimates", rotation=270, labelpad=20, fontsize=14)
+        else:
+            colorbar.update_normal(im)
     if plot_title != None:
         ax.set_title(plot_title)
     plt.tick_params(axis="both", labelsize=0, length=0)
     return ax
 
 
+def _download(url, filepath, md5=None):
+    """
+    Streams a file from a url to disk, verifying its md5 checksum if given.
+    The file is written to a temporary path first, so that an interrupted
+    download never leaves a partial file at `filepath`.
+    """
+    tmppath = filepath + ".tmp"
+    digest = hashlib.md5()
+    try:
+        with urlopen(url) as response, open(tmppath, "wb") as f:
+            while True:
+                chunk = response.read(1 << 20)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        if md5 is not None and digest.hexdigest() != md5:
+            raise Exception("Checksum mismatch for file downloaded from %s" % url)
+        os.replace(tmppath, filepath)
+    finally:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+
+
 # Taken from https://mattpetersen.github.io/load-cifar10-with-numpy
 def cifar10(path=None):
     r"""Return (train_images, train_labels, test_images, test_labels).
@@ -231,6 +461,8 @@ def cifar10(path=None):
     """
     url = "https://www.cs.toronto.edu/~kriz/"
     tar = "cifar-10-binary.tar.gz"
+    # Checksum published at https://www.cs.toronto.edu/~kriz/cifar.html
+    tar_md5 = "c32a1d4ab5d03f1284b67883e8d87530"
     files = [
         "cifar-10-batches-bin/data_batch_1.bin",
         "cifar-10-batches-bin/data_batch_2.bin",
@@ -248,17 +480,23 @@ def cifar10(path=None):
     os.makedirs(path, exist_ok=True)
 
     # Download tarfile if missing
-    if tar not in os.listdir(path):
-        urlretrieve("".join((url, tar)), os.path.join(path, tar))
+    tarpath = os.path.join(path, tar)
+    if not os.path.isfile(tarpath):
+        _download("".join((url, tar)), tarpath, tar_md5)
         print("Downloaded %s to %s" % (tar, path))
 
     # Load data from tarfile
-    with tarfile.open(os.path.join(path, tar)) as tar_object:
+    with tarfile.open(tarpath) as tar_object:
         # Each file contains 10,000 color images and 10,000 labels
-        fsize = 10000 * (32 * 32 * 3) + 10000
+        # -- Examples are in chunks of 3,073 bytes
+        # -- First byte of each chunk is the label
+        # -- Next 32 * 32 * 3 = 3,072 bytes are its corresponding image
+        fsize = 10000
+        chunk_size = 32 * 32 * 3 + 1
 
         # There are 6 files (5 train and 1 test)
-        buffr = np.zeros(fsize * 6, dtype="uint8")
+        # -- Every byte is overwritten below, so the buffer is left uninitialized
+        buffr = np.empty((fsize * 6, chunk_size), dtype="uint8")
 
         # Get members of tar corresponding to data files
         # -- The tar contains README's and other extraneous stuff
@@ -273,21 +511,25 @@ def cifar10(path=None):
         for i, member in enumerate(members):
             # Get member as a file object
             f = tar_object.extractfile(member)
-            # Read bytes from that file object into buffr
-            buffr[i * fsize : (i + 1) * fsize] = np.frombuffer(f.read(), "B")
-
-    # Parse data from buffer
-    # -- Examples are in chunks of 3,073 bytes
-    # -- First byte of each chunk is the label
-    # -- Next 32 * 32 * 3 = 3,072 bytes are its corresponding image
-
-    # Labels are the first byte of every chunk
-    labels = buffr[::3073]
-
-    # Pixels are everything remaining after we delete the labels
-    pixels = np.delete(buffr, np.arange(0, buffr.size, 3073))
-    images = (pixels.reshape(-1, 3072).astype("float32") / 255).reshape(
-        -1, 32, 32, 3, order="F"
+            # Read the chunks from that file object into rows of buffr
+            buffr[i * fsize : (i + 1) * fsize] = np.frombuffer(
+                f.read(), "B"
+            ).reshape(fsize, chunk_size)
+
+    # Labels are the first byte of every chunk, pixels are the rest
+    # -- Both are views into buffr, so nothing is copied here
+    labels = buffr[:, 0]
+    pixels = buffr[:, 1:]
+
+    # Each image is stored as 3 channels of 32 x 32 rows, and is loaded with
+    # the channels last and the rows and columns swapped
+    # -- The environments rotate each image back into place
+    # -- Converting, scaling and transposing happen in one pass over the pixels
+    images = np.empty((len(pixels), 32, 32, 3), dtype=np.float32)
+    np.divide(
+        pixels.reshape(-1, 3, 32, 32).transpose(0, 3, 2, 1),
+        np.float32(255),
+        out=images,
     )
 
     # Split into train and test
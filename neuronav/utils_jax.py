@@ -0,0 +1,60 @@
+"""
+JAX versions of the utilities in `neuronav.utils`, together with jitted
+and vmapped entry points for `neuronav.utils.run_episode_scan`, so that
+agents and environments written as pure functions can be compiled with
+XLA and run on GPU/TPU. The NumPy utilities remain the default for the
+gym compatible environments in `neuronav.envs`.
+Requires `jax`, which can be installed with `pip install neuronav[jax]`.
+"""
+import functools
+import jax
+import jax.numpy as jnp
+from neuronav.utils import run_episode_scan
+
+
+def onehot(value, max_value: int):
+    """
+    Creates a onehot encoding of an integer number.
+    """
+    value = jnp.clip(value, 0, max_value - 1)
+    return jax.nn.one_hot(value, max_value, dtype=jnp.int32)
+
+
+def twohot(value, max_value: int):
+    """
+    Creates a two-hot encoding of a given pair of integers.
+    """
+    return jax.nn.one_hot(value, max_value, dtype=jnp.float32).reshape(-1)
+
+
+def softmax(x, axis=-1):
+    """
+    Computes the softmax function on a given array along an axis.
+    """
+    return jax.nn.softmax(x, axis=axis)
+
+
+def run_episodes_scan(
+    env_step,
+    agent_step,
+    agent_update,
+    max_steps: int,
+    env_state,
+    agent_state,
+    obs,
+    keys,
+):
+    """
+    Performs one episode per key in `keys` in parallel with `jax.vmap`,
+    with every episode starting from the same initial states.
+    """
+    rollout = functools.partial(
+        run_episode_scan, env_step, agent_step, agent_update, max_steps
+    )
+    return jax.vmap(rollout, in_axes=(None, None, None, 0))(
+        env_state, agent_state, obs, keys
+    )
+
+
+run_episode_jit = jax.jit(run_episode_scan, static_argnums=(0, 1, 2, 3))
+run_episodes_jit = jax.jit(run_episodes_scan, static_argnums=(0, 1, 2, 3))
@@ -7,6 +7,8 @@ required = ["numpy", "gym", "matplotlib", "scipy", "networkx", "opencv-python"]
 extras_required = {
     "experiments_local": ["jupyterlab", "sklearn", "torch"],
     "experiments_remote": ["sklearn", "torch"],
+    "jax": ["jax"],
+    "numba": ["numba"],
 }
 
 setup(
@@ -1,8 +1,22 @@
+import pytest
 import numpy as np
-from neuronav.utils import onehot, twohot, run_episode, plot_values_and_policy
+from neuronav.utils import (
+    onehot,
+    onehot_batch,
+    twohot,
+    twohot_batch,
+    softmax,
+    create_circular_mask,
+    run_episode,
+    plot_values_and_policy,
+)
 from neuronav.envs.graph_env import GraphEnv, GraphObsType
 from neuronav.envs.grid_env import GridEnv, GridSize, GridObsType, OrientationType
-from neuronav.envs.graph_structures import GraphStructure
+from neuronav.envs.graph_structures import (
+    GraphStructure,
+    structure_map,
+    structure_csr,
+)
 from neuronav.envs.grid_topographies import GridTopography
 from neuronav.agents.td_agents import QET, TDQ, TDAC, TDSR
 from neuronav.agents.dyna_agents import DynaQ, DynaAC, DynaSR
@@ -20,12 +34,61 @@ def test_two_hot():
     assert a.all() == np.array([0, 1, 0, 0, 1, 0]).all()
 
 
+def test_two_hot_out():
+    out = np.ones(6, dtype=np.float32)
+    a = twohot([0, 2], 3, out=out)
+    assert a is out
+    assert (a == np.array([1, 0, 0, 0, 0, 1])).all()
+
+
+def test_one_hot_writeable():
+    a = onehot(1, 5)
+    a += 1
+    assert (onehot(1, 5) == np.array([0, 1, 0, 0, 0])).all()
+    obs = GridEnv(obs_type=GridObsType.onehot).reset()
+    assert obs.flags.writeable
+
+
+def test_one_hot_batch():
+    a = onehot_batch(np.array([0, 2, 7]), 5)
+    assert (a == np.array([onehot(0, 5), onehot(2, 5), onehot(7, 5)])).all()
+
+
+def test_two_hot_batch():
+    a = twohot_batch(np.array([[1, 1], [0, 2]]), 3)
+    assert (a == np.array([twohot([1, 1], 3), twohot([0, 2], 3)])).all()
+
+
+def test_softmax():
+    x = np.array([[1.0, 2.0, 3.0], [1000.0, 1000.0, 1000.0]])
+    a = softmax(x)
+    assert np.allclose(a.sum(-1), 1.0)
+    assert np.allclose(a[1], 1.0 / 3.0)
+    assert np.allclose(softmax(x, axis=0).sum(0), 1.0)
+
+    v = np.array([0.5, -1.0, 2.0, 0.0])
+    expected = np.exp(v - v.max()) / np.exp(v - v.max()).sum()
+    assert np.allclose(softmax(v), expected)
+    out = np.empty(4)
+    assert softmax(v, out=out) is out
+    assert np.allclose(out, expected)
+
+
 def test_plot_value_policy():
     env = GridEnv()
     agent = TDQ(env.state_size, env.action_space.n)
     plot_values_and_policy(agent, env, [9, 9], "Test Plot")
 
 
+def test_plot_reward_labels():
+    env = GridEnv()
+    agent = TDQ(env.state_size, env.action_space.n)
+    objects = {'rewards': {(1, 1): 1, 3 * env.grid_size + 2: -0.5}, 'markers': {}}
+    ax = plot_values_and_policy(agent, env, [9, 9], rollout=False, objects=objects)
+    labels = sorted(text.get_text() for text in ax.texts)
+    assert labels == ["-0.5", "1", "S"]
+
+
 def test_graph_obs():
     for obs_type in GraphObsType:
         env = GraphEnv(obs_type=obs_type)
@@ -154,3 +217,165 @@ def test_grid_episode():
     grid_env = GridEnv()
     grid_agent = TDQ(grid_env.state_size, grid_env.action_space.n)
     _, _, _ = run_episode(grid_env, grid_agent, 100)
+
+
+def test_graph_structure_cache():
+    for structure in GraphStructure:
+        objects, edges = structure_map[structure]()
+        assert structure_map[structure]()[1] is edges
+        env = GraphEnv(graph_structure=structure)
+        env.edges[0] = []
+        assert len(structure_map[structure]()[1][0]) > 0
+
+
+def test_graph_structure_csr():
+    _, (indptr, indices, delta, probs) = structure_csr(GraphStructure.two_step)
+    assert indptr.tolist() == [0, 2, 4, 6, 6, 6, 6, 6]
+    assert indices.tolist() == [1, 2, 3, 4, 5, 6]
+    assert delta.tolist() == [2, 2, 2, 0, 0, 0, 0]
+    _, (indptr, indices, delta, probs) = structure_csr(
+        GraphStructure.variable_magnitude
+    )
+    assert indices.tolist() == [1, 2, 3, 4, 5, 6, 7]
+    assert np.isclose(probs.sum(), 1.0)
+
+
+def test_collect_states():
+    grid_env = GridEnv()
+    grid_agent = TDQ(grid_env.state_size, grid_env.action_space.n)
+    _, steps, _, states = run_episode(grid_env, grid_agent, 100, collect_states=True)
+    assert states.shape == (steps,)
+    assert states[0] == grid_env.get_observation(grid_env.agent_start_pos)
+
+
+def test_graph_neighbors():
+    env = GraphEnv(graph_structure=GraphStructure.t_graph)
+    neighbors = env.get_neighbors([0, 4, 5])
+    assert neighbors.tolist() == [[1, 0], [6, 4], [-1, -1]]
+    env.edges[5] = [3]
+    assert env.get_neighbors([5], rebuild=True).tolist() == [[3, -1]]
+    env = GraphEnv(graph_structure=GraphStructure.variable_magnitude)
+    assert env.get_neighbors([0]).tolist() == [[1, 2, 3, 4, 5, 6, 7]]
+
+
+def test_collect_transitions():
+    graph_env = GraphEnv()
+    graph_agent = TDQ(graph_env.state_size, graph_env.action_space.n)
+    _, steps, episode_return, transitions = run_episode(
+        graph_env, graph_agent, 100, collect_transitions=True
+    )
+    assert transitions.shape == (steps,)
+    assert transitions["reward"].sum() == episode_return
+    assert transitions["done"][-1]
+    assert (transitions["obs"][1:] == transitions["obs_new"][:-1]).all()
+
+
+def test_graph_stochastic_edges():
+    np.random.seed(0)
+    env = GraphEnv(graph_structure=GraphStructure.variable_magnitude)
+    counts = np.zeros(env.state_size)
+    for _ in range(20000):
+        env.reset()
+        obs, _, _, _ = env.step(0)
+        counts[obs] += 1
+    targets, probs = env.edges[0][0]
+    assert np.allclose(counts[list(targets)] / counts.sum(), probs, atol=0.01)
+
+
+def test_graph_rewards_mutation():
+    env = GraphEnv(graph_structure=GraphStructure.linear)
+    env.struct_objects['rewards'][5] = -3
+    env.reset(agent_pos=4)
+    assert env.step(0)[1] == -3
+    env.reset()
+    env.objects['rewards'][1] = 7
+    assert env.step(0)[1] == 7
+    env.reset(objects={'rewards': {1: 2}})
+    assert env.step(0)[1] == 2
+
+
+def test_run_episode_scan():
+    jax = pytest.importorskip("jax")
+    import jax.numpy as jnp
+    from neuronav.utils import run_episode_scan
+
+    # A chain which ends with a reward of 1 after five steps
+    def env_step(state, action, key):
+        state = state + 1
+        return state, state, jnp.where(state == 5, 1.0, 0.0), state == 5
+
+    def agent_step(agent_state, obs, key):
+        return jnp.int32(0)
+
+    def agent_update(agent_state, transition):
+        return agent_state + 1
+
+    agent_state, steps, episode_return, transitions = run_episode_scan(
+        env_step,
+        agent_step,
+        agent_update,
+        10,
+        jnp.int32(0),
+        jnp.int32(0),
+        jnp.int32(0),
+        jax.random.PRNGKey(0),
+    )
+    assert steps == 5
+    assert episode_return == 1.0
+    assert transitions["valid"].tolist() == [True] * 5 + [False] * 5
+    assert agent_state == 5
+
+
+def test_run_episode_jit():
+    jax = pytest.importorskip("jax")
+    import jax.numpy as jnp
+    from neuronav.utils_jax import run_episode_jit, run_episodes_jit
+
+    # A chain which ends with a reward of 1 after five steps
+    def env_step(state, action, key):
+        state = state + 1
+        return state, state, jnp.where(state == 5, 1.0, 0.0), state == 5
+
+    def agent_step(agent_state, obs, key):
+        return jnp.int32(0)
+
+    def agent_update(agent_state, transition):
+        return agent_state + 1
+
+    agent_state, steps, episode_return, _ = run_episode_jit(
+        env_step,
+        agent_step,
+        agent_update,
+        10,
+        jnp.int32(0),
+        jnp.int32(0),
+        jnp.int32(0),
+        jax.random.PRNGKey(0),
+    )
+    assert steps == 5
+    assert episode_return == 1.0
+    assert agent_state == 5
+
+    keys = jax.random.split(jax.random.PRNGKey(0), 4)
+    _, steps, episode_return, _ = run_episodes_jit(
+        env_step,
+        agent_step,
+        None,
+        10,
+        jnp.int32(0),
+        jnp.int32(0),
+        jnp.int32(0),
+        keys,
+    )
+    assert steps.tolist() == [5] * 4
+    assert episode_return.tolist() == [1.0] * 4
+
+
+def test_circular_mask():
+    for center in [None, [4, 5], [4.5, 4.5]]:
+        h, w = 10, 10
+        mask_center = center if center is not None else [w // 2, h // 2]
+        Y, X = np.ogrid[:h, :w]
+        dist = np.sqrt((X - mask_center[0]) ** 2 + (Y - mask_center[1]) ** 2)
+        expected = dist <= 3
+        assert (create_circular_mask(h, w, center=center, radius=3) == expected).all()